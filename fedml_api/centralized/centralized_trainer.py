@@ -1,9 +1,15 @@
 import copy
 import logging
+import multiprocessing
+import os
+import pickle
 
 import torch
 import wandb
 from torch import nn
+from torch.utils import data
+
+from .data_prefetcher import CUDAPrefetcher
 
 
 class CentralizedTrainer(object):
@@ -16,8 +22,8 @@ class CentralizedTrainer(object):
         self.args = args
         [train_data_num, test_data_num, train_data_global, test_data_global,
          train_data_local_num_dict, train_data_local_dict, test_data_local_dict, class_num] = dataset
-        self.train_global = train_data_global
-        self.test_global = test_data_global
+        self.train_global = CUDAPrefetcher(self._tune_loader(train_data_global, is_train=True), device)
+        self.test_global = CUDAPrefetcher(self._tune_loader(test_data_global, is_train=False), device)
         self.train_data_num_in_total = train_data_num
         self.test_data_num_in_total = test_data_num
         self.train_data_local_num_dict = train_data_local_num_dict
@@ -26,78 +32,175 @@ class CentralizedTrainer(object):
 
         self.model = model
         self.model.to(self.device)
+        # NHWC lets cuDNN run convolutions on tensor cores without layout transposes
+        self.model.to(memory_format=torch.channels_last)
+        if self.args.compile == 1:
+            if hasattr(torch, "compile"):
+                # let Inductor fuse the pointwise/normalization epilogues into a few kernels; batches have a fixed
+                # shape (the train loader drops its last partial batch), so specialize on it
+                self.model = torch.compile(self.model, mode="max-autotune", dynamic=False, fullgraph=False)
+            else:
+                logging.warning("--compile 1 requires PyTorch >= 2.0 (found %s); the model runs eagerly."
+                                % torch.__version__)
         self.criterion = nn.CrossEntropyLoss()
         if self.args.client_optimizer == "sgd":
-            self.optimizer = torch.optim.SGD(self.model.parameters(), lr=self.args.lr)
+            self.optimizer = self._create_optimizer(torch.optim.SGD, list(self.model.parameters()), lr=self.args.lr)
         else:
-            self.optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, self.model.parameters()),
-                                              lr=self.args.lr,
-                                              weight_decay=self.args.wd, amsgrad=True)
+            self.optimizer = self._create_optimizer(torch.optim.Adam,
+                                                    [p for p in self.model.parameters() if p.requires_grad],
+                                                    lr=self.args.lr,
+                                                    weight_decay=self.args.wd, amsgrad=True)
+
+        # mixed precision: bf16 on Ampere+ needs no loss scaling, fp16 relies on the GradScaler
+        self.use_amp = self.args.amp == 1 and self.device.type == "cuda"
+        self.amp_dtype = torch.bfloat16 if self.use_amp and torch.cuda.is_bf16_supported() else torch.float16
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_amp and self.amp_dtype == torch.float16)
+
+    def _create_optimizer(self, optimizer_class, params, **kwargs):
+        # fused/foreach implementations update all parameters with a few multi-tensor kernels instead of
+        # several kernels per parameter; fused needs a recent PyTorch, so fall back to foreach, then to the default.
+        if self.device.type == "cuda":
+            for impl in ["fused", "foreach"]:
+                try:
+                    return optimizer_class(params, **kwargs, **{impl: True})
+                except (TypeError, RuntimeError):
+                    continue
+        return optimizer_class(params, **kwargs)
+
+    def _tune_loader(self, loader, is_train):
+        # the global loaders are built without worker processes since they share their construction with
+        # the per-client loaders; a single centralized job can afford persistent workers.
+        # Some datasets (e.g., mnist, shakespeare) provide plain lists of batches, which are used as they are.
+        if not isinstance(loader, data.DataLoader) or isinstance(loader.dataset, data.IterableDataset):
+            return loader
+        # only plain samplers are rebuilt; a custom batch_sampler cannot be re-created from its dataset
+        if type(loader.batch_sampler) is not data.BatchSampler:
+            logging.info("keep the original loader since it uses a custom batch_sampler")
+            return loader
+        # fixed batch shapes for training, unless the training set does not fill even one batch
+        drop_last = loader.drop_last
+        if is_train and len(loader.dataset) >= loader.batch_size:
+            drop_last = True
+        num_workers = min(self.args.data_loader_workers, os.cpu_count() or 1)
+        if num_workers > 0 and multiprocessing.get_context().get_start_method() != "fork" and not self._is_picklable(loader):
+            # spawned workers receive a pickled copy of the dataset; datasets holding local lambdas
+            # (e.g., stackoverflow_lr's preprocessing) can only be loaded in the main process
+            logging.warning("the %s dataset cannot be pickled, load it in the main process"
+                            % type(loader.dataset).__name__)
+            num_workers = 0
+        worker_kwargs = dict()
+        if num_workers > 0:
+            worker_kwargs = dict(persistent_workers=True, prefetch_factor=2)
+        return data.DataLoader(dataset=loader.dataset, batch_size=loader.batch_size,
+                               sampler=loader.sampler,
+                               collate_fn=loader.collate_fn,
+                               drop_last=drop_last,
+                               num_workers=num_workers, pin_memory=True, **worker_kwargs)
+
+    def _is_picklable(self, loader):
+        try:
+            pickle.dumps((loader.dataset, loader.collate_fn))
+        except (pickle.PicklingError, AttributeError, TypeError):
+            return False
+        return True
 
     def train(self):
         for epoch in range(self.args.epochs):
-            self.train_impl(epoch)
-            self.eval_impl(epoch)
+            train_metrics = self.train_impl(epoch)
+            self.eval_impl(epoch, train_metrics)
 
     def train_impl(self, epoch_idx):
         self.model.train()
+        # training metrics are collected from the forward passes we already run, instead of
+        # re-evaluating the whole training set after each epoch.
+        metrics = self._init_metrics()
+        # gradients of grad_accum_steps consecutive batches are summed before each optimizer step
+        accum_steps = self.args.grad_accum_steps
+        num_batches = len(self.train_global)
+        self.optimizer.zero_grad(set_to_none=True)
         for batch_idx, (x, labels) in enumerate(self.train_global):
             # logging.info(images.shape)
-            x, labels = x.to(self.device), labels.to(self.device)
-            self.optimizer.zero_grad()
-            log_probs = self.model(x)
-            loss = self.criterion(log_probs, labels)
-            loss.backward()
-            self.optimizer.step()
-            logging.info('Local Training Epoch: {} {}-th iters\t Loss: {:.6f}'.format(epoch_idx,
-                                                                                      batch_idx, loss.item()))
-
-    def eval_impl(self, epoch_idx):
+            x = self._to_channels_last(x)
+            with torch.cuda.amp.autocast(enabled=self.use_amp, dtype=self.amp_dtype):
+                log_probs = self.model(x)
+                loss = self.criterion(log_probs, labels)
+            # the last window of an epoch may hold fewer than accum_steps batches
+            window_size = min(accum_steps, num_batches - (batch_idx // accum_steps) * accum_steps)
+            self.scaler.scale(loss / window_size).backward()
+            if (batch_idx + 1) % accum_steps == 0 or batch_idx + 1 == num_batches:
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                self.optimizer.zero_grad(set_to_none=True)
+            with torch.no_grad():
+                self._update_metrics(metrics, log_probs, labels, loss)
+        metrics = self._sync_metrics(metrics)
+        logging.info('Local Training Epoch: {} \tLoss: {:.6f}'.format(
+            epoch_idx, metrics['test_loss'] / max(metrics['test_total'], 1)))
+        return metrics
+
+    def _to_channels_last(self, x):
+        # only image batches (N, C, H, W) have a channels_last layout
+        if x.dim() == 4:
+            return x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    def eval_impl(self, epoch_idx, train_metrics):
         # train
         if epoch_idx % self.args.frequency_of_train_acc_report == 0:
-            self.test_on_all_clients(b_is_train=True, epoch_idx=epoch_idx)
+            self.save_log(b_is_train=True, metrics=train_metrics, epoch_idx=epoch_idx)
 
         # test
         if epoch_idx % self.args.frequency_of_train_acc_report == 0:
             self.test_on_all_clients(b_is_train=False, epoch_idx=epoch_idx)
 
-    def test_on_all_clients(self, b_is_train, epoch_idx):
-        self.model.eval()
-        metrics = {
-            'test_correct': 0,
-            'test_loss': 0,
-            'test_precision': 0,
-            'test_recall': 0,
+    def _init_metrics(self):
+        # accumulate on the device and synchronize once after the loop
+        return {
+            'test_correct': torch.zeros((), device=self.device),
+            'test_loss': torch.zeros((), device=self.device),
+            'test_precision': torch.zeros((), device=self.device),
+            'test_recall': torch.zeros((), device=self.device),
             'test_total': 0
         }
+
+    def _update_metrics(self, metrics, pred, target, loss):
+        if self.args.dataset == "stackoverflow_lr":
+            predicted = (pred > .5).int()
+            correct = predicted.eq(target).sum(axis=-1).eq(target.size(1)).sum()
+            true_positive = ((target * predicted) > .1).int().sum(axis=-1)
+            precision = true_positive / (predicted.sum(axis=-1) + 1e-13)
+            recall = true_positive / (target.sum(axis=-1) + 1e-13)
+            metrics['test_precision'] += precision.sum()
+            metrics['test_recall'] += recall.sum()
+        else:
+            _, predicted = torch.max(pred, -1)
+            correct = predicted.eq(target).sum()
+
+        metrics['test_correct'] += correct
+        metrics['test_loss'] += loss.detach() * target.size(0)
+        metrics['test_total'] += target.size(0)
+
+    def _sync_metrics(self, metrics):
+        for key in ['test_correct', 'test_loss', 'test_precision', 'test_recall']:
+            metrics[key] = metrics[key].item()
+        return metrics
+
+    def test_on_all_clients(self, b_is_train, epoch_idx):
+        self.model.eval()
+        metrics = self._init_metrics()
         if b_is_train:
             test_data = self.train_global
         else:
             test_data = self.test_global
         with torch.no_grad():
             for batch_idx, (x, target) in enumerate(test_data):
-                x = x.to(self.device)
-                target = target.to(self.device)
-                pred = self.model(x)
-                loss = self.criterion(pred, target)
-
-                if self.args.dataset == "stackoverflow_lr":
-                    predicted = (pred > .5).int()
-                    correct = predicted.eq(target).sum(axis=-1).eq(target.size(1)).sum()
-                    true_positive = ((target * predicted) > .1).int().sum(axis=-1)
-                    precision = true_positive / (predicted.sum(axis=-1) + 1e-13)
-                    recall = true_positive / (target.sum(axis=-1) + 1e-13)
-                    metrics['test_precision'] += precision.sum().item()
-                    metrics['test_recall'] += recall.sum().item()
-                else:
-                    _, predicted = torch.max(pred, -1)
-                    correct = predicted.eq(target).sum()
-
-                metrics['test_correct'] += correct.item()
-                metrics['test_loss'] += loss.item() * target.size(0)
-                metrics['test_total'] += target.size(0)
-
-        self.save_log(b_is_train=b_is_train, metrics=metrics, epoch_idx=epoch_idx)
+                x = self._to_channels_last(x)
+                with torch.cuda.amp.autocast(enabled=self.use_amp, dtype=self.amp_dtype):
+                    pred = self.model(x)
+                    loss = self.criterion(pred, target)
+                self._update_metrics(metrics, pred, target, loss)
+
+        self.save_log(b_is_train=b_is_train, metrics=self._sync_metrics(metrics), epoch_idx=epoch_idx)
 
     def save_log(self, b_is_train, metrics, epoch_idx):
         prefix = 'Train' if b_is_train else 'Test'
@@ -118,6 +221,10 @@ class CentralizedTrainer(object):
             all_metrics['precisions'].append(copy.deepcopy(metrics['test_precision']))
             all_metrics['recalls'].append(copy.deepcopy(metrics['test_recall']))
 
+        if sum(all_metrics['num_samples']) == 0:
+            logging.warning("%s: no samples were evaluated at epoch %d, skip logging" % (prefix, epoch_idx))
+            return
+
         # performance on all clients
         acc = sum(all_metrics['num_correct']) / sum(all_metrics['num_samples'])
         loss = sum(all_metrics['losses']) / sum(all_metrics['num_samples'])
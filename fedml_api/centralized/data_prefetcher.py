@@ -0,0 +1,42 @@
+import torch
+
+
+class CUDAPrefetcher(object):
+    r"""
+    Wrap a DataLoader so that the host-to-device copy of the next batch runs on a side CUDA stream
+    while the current batch is being computed. On CPU devices batches are simply moved to the device.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device) if device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.stream is None:
+            for x, target in self.loader:
+                yield x.to(self.device), target.to(self.device)
+            return
+
+        first = True
+        for next_x, next_target in self.loader:
+            with torch.cuda.stream(self.stream):
+                next_x = next_x.to(self.device, non_blocking=True)
+                next_target = next_target.to(self.device, non_blocking=True)
+
+            if not first:
+                yield x, target
+            else:
+                first = False
+
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            # the tensors were allocated on the side stream; keep their memory alive for the compute stream
+            next_x.record_stream(torch.cuda.current_stream(self.device))
+            next_target.record_stream(torch.cuda.current_stream(self.device))
+            x, target = next_x, next_target
+
+        if not first:
+            yield x, target
@@ -0,0 +1,67 @@
+import functools
+import logging
+
+import torch
+from torch import nn
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.utils.checkpoint import checkpoint
+
+
+def _batch_norm_stats(block):
+    return [(m, [m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone()])
+            for m in block.modules() if isinstance(m, _BatchNorm) and m.track_running_stats]
+
+
+def _restore_batch_norm_stats(saved_stats):
+    with torch.no_grad():
+        for m, (running_mean, running_var, num_batches_tracked) in saved_stats:
+            m.running_mean.copy_(running_mean)
+            m.running_var.copy_(running_var)
+            m.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def _checkpointed_forward(block, forward, *inputs, **kwargs):
+    if not torch.is_grad_enabled():
+        return forward(*inputs, **kwargs)
+
+    # checkpoint() calls run() once in forward and once more to recompute in backward. Both calls run in
+    # train mode, so the BatchNorm running statistics are rolled back after the recompute to keep
+    # exactly one update per step. The rollback sits in a finally block because PyTorch >= 2.1 stops
+    # the recompute early by raising from inside forward once the last saved tensor is rebuilt.
+    calls = []
+
+    def run(*args, **kw):
+        if not calls:
+            calls.append(True)
+            return forward(*args, **kw)
+        saved_stats = _batch_norm_stats(block)
+        try:
+            return forward(*args, **kw)
+        finally:
+            _restore_batch_norm_stats(saved_stats)
+
+    return checkpoint(run, *inputs, use_reentrant=False, **kwargs)
+
+
+def enable_grad_checkpoint(model):
+    """
+    Trade compute for memory: the blocks held in the model's top-level nn.Sequential/nn.ModuleList
+    containers (e.g., ResNet layers, MobileNetV3 blocks, EfficientNet MBConv blocks) drop their
+    activations in forward and recompute them in backward. BatchNorm running statistics are restored
+    after the recompute, so they are updated exactly as without checkpointing.
+    """
+    num_blocks = 0
+    for container in model.children():
+        if not isinstance(container, (nn.Sequential, nn.ModuleList)):
+            continue
+        for block in container:
+            # single layers (conv, bn, activation) are not worth recomputing on their own
+            if len(list(block.children())) == 0:
+                continue
+            block.forward = functools.partial(_checkpointed_forward, block, block.forward)
+            num_blocks += 1
+    if num_blocks == 0:
+        logging.warning("--grad_checkpoint 1 has no effect: %s has no blocks to checkpoint"
+                        % type(model).__name__)
+    else:
+        logging.info("gradient checkpointing enabled for %d blocks" % num_blocks)
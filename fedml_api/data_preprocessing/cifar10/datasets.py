@@ -1,4 +1,5 @@
 import logging
+import os
 
 import numpy as np
 import torch.utils.data as data
@@ -11,6 +12,18 @@ logger.setLevel(logging.INFO)
 
 IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff', '.webp')
 
+# decoded (data, target) arrays keyed by (root, train); every client's truncated dataset indexes into the
+# same arrays instead of unpickling the whole CIFAR10 split from disk again.
+_CIFAR10_CACHE = {}
+
+
+def load_cifar10_arrays(root, train, download):
+    key = (os.path.abspath(root), train)
+    if key not in _CIFAR10_CACHE:
+        cifar_dataobj = CIFAR10(root, train, None, None, download)
+        _CIFAR10_CACHE[key] = (cifar_dataobj.data, np.array(cifar_dataobj.targets))
+    return _CIFAR10_CACHE[key]
+
 
 def accimage_loader(path):
     import accimage
@@ -51,20 +64,15 @@ class CIFAR10_truncated(data.Dataset):
 
     def __build_truncated_dataset__(self):
         print("download = " + str(self.download))
-        cifar_dataobj = CIFAR10(self.root, self.train, self.transform, self.target_transform, self.download)
-
-        if self.train:
-            # print("train member of the class: {}".format(self.train))
-            # data = cifar_dataobj.train_data
-            data = cifar_dataobj.data
-            target = np.array(cifar_dataobj.targets)
-        else:
-            data = cifar_dataobj.data
-            target = np.array(cifar_dataobj.targets)
+        data, target = load_cifar10_arrays(self.root, self.train, self.download)
 
         if self.dataidxs is not None:
             data = data[self.dataidxs]
             target = target[self.dataidxs]
+        else:
+            # truncate_channel() writes into self.data, so never hand out the cached arrays themselves
+            data = data.copy()
+            target = target.copy()
 
         return data, target
 
@@ -1,4 +1,5 @@
 import logging
+import os
 
 import numpy as np
 import torch.utils.data as data
@@ -11,6 +12,18 @@ logger.setLevel(logging.INFO)
 
 IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff', '.webp')
 
+# decoded (data, target) arrays keyed by (root, train); every client's truncated dataset indexes into the
+# same arrays instead of unpickling the whole CIFAR100 split from disk again.
+_CIFAR100_CACHE = {}
+
+
+def load_cifar100_arrays(root, train, download):
+    key = (os.path.abspath(root), train)
+    if key not in _CIFAR100_CACHE:
+        cifar_dataobj = CIFAR100(root, train, None, None, download)
+        _CIFAR100_CACHE[key] = (cifar_dataobj.data, np.array(cifar_dataobj.targets))
+    return _CIFAR100_CACHE[key]
+
 
 def accimage_loader(path):
     import accimage
@@ -50,21 +63,15 @@ class CIFAR100_truncated(data.Dataset):
         self.data, self.target = self.__build_truncated_dataset__()
 
     def __build_truncated_dataset__(self):
-
-        cifar_dataobj = CIFAR100(self.root, self.train, self.transform, self.target_transform, self.download)
-
-        if self.train:
-            # print("train member of the class: {}".format(self.train))
-            # data = cifar_dataobj.train_data
-            data = cifar_dataobj.data
-            target = np.array(cifar_dataobj.targets)
-        else:
-            data = cifar_dataobj.data
-            target = np.array(cifar_dataobj.targets)
+        data, target = load_cifar100_arrays(self.root, self.train, self.download)
 
         if self.dataidxs is not None:
             data = data[self.dataidxs]
             target = target[self.dataidxs]
+        else:
+            # truncate_channel() writes into self.data, so never hand out the cached arrays themselves
+            data = data.copy()
+            target = target.copy()
 
         return data, target
 
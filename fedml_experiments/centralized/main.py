@@ -13,6 +13,7 @@ import wandb
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../../")))
 from fedml_api.centralized.centralized_trainer import CentralizedTrainer
+from fedml_api.centralized.grad_checkpoint import enable_grad_checkpoint
 from fedml_api.data_preprocessing.FederatedEMNIST.data_loader import load_partition_data_federated_emnist
 from fedml_api.data_preprocessing.fed_cifar100.data_loader import load_partition_data_federated_cifar100
 from fedml_api.data_preprocessing.fed_shakespeare.data_loader import load_partition_data_federated_shakespeare
@@ -67,6 +68,9 @@ def add_args(parser):
     parser.add_argument('--batch_size', type=int, default=64, metavar='N',
                         help='input batch size for training (default: 64)')
 
+    parser.add_argument('--grad_accum_steps', type=int, default=1, metavar='N',
+                        help='number of batches whose gradients are accumulated per optimizer step (default: 1)')
+
     parser.add_argument('--client_optimizer', type=str, default='adam',
                         help='SGD with momentum; adam')
 
@@ -102,7 +106,23 @@ def add_args(parser):
     parser.add_argument('--gpu', type=int, default=0,
                         help='gpu')
 
+    parser.add_argument('--amp', type=int, default=1,
+                        help='whether to use automatic mixed precision (bf16 on Ampere+, fp16 otherwise) on GPU')
+
+    parser.add_argument('--data_loader_workers', type=int, default=8,
+                        help='worker processes per global data loader, capped by the CPU count; 0 loads in the main process')
+
+    parser.add_argument('--compile', type=int, default=0,
+                        help='whether to compile the model with torch.compile (requires PyTorch >= 2.0)')
+
+    parser.add_argument('--grad_checkpoint', type=int, default=0,
+                        help='whether to recompute block activations in backward to save memory')
+
     args = parser.parse_args()
+    if args.grad_accum_steps < 1:
+        parser.error("--grad_accum_steps must be >= 1")
+    if args.data_loader_workers < 0:
+        parser.error("--data_loader_workers must be >= 0")
     return args
 
 
@@ -265,6 +285,8 @@ def create_model(args, model_name, output_dim):
         model = EfficientNet.from_name(
             model_name='efficientnet-b0', num_classes=output_dim)
 
+    if model is not None and args.grad_checkpoint == 1:
+        enable_grad_checkpoint(model)
     return model
 
 
@@ -312,6 +334,12 @@ if __name__ == "__main__":
     torch.manual_seed(0)
     torch.cuda.manual_seed_all(0)
 
+    # run fp32 matmuls/convolutions on tensor cores (TF32) on Ampere+ GPUs; input sizes are fixed per dataset,
+    # so cuDNN can safely benchmark and cache the fastest convolution algorithms.
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+
     # GPU arrangement: Please customize this function according your own topology.
     # The GPU server list is configured at "mpi_host_file".
     # If we have 4 machines and each has two GPUs, and your FL network has 8 workers and a central worker.